@@ -15,17 +15,38 @@ It uses the same principles as Google's boilerplate detection:
 
 import os
 import re
+import math
+import bisect
+import itertools
 import time
 import random
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Callable, Optional
-import json
+from urllib.parse import urlparse
+
+import orjson
 
 import requests
+from requests.adapters import HTTPAdapter
 import trafilatura
+from diskcache import Cache
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.model import JsonModel
 from sentence_transformers import SentenceTransformer
 import numpy as np
+import torch
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
 
 
 # ============================================================
@@ -33,46 +54,184 @@ import numpy as np
 # ============================================================
 MIN_CONTENT_LENGTH = 200
 MIN_WORDS = 30
+MAX_HTML_BYTES = 1_000_000  # trafilatura never needs more than the first MB
+CHARS_PER_TOKEN = 6  # rough average for English WordPiece text; an approximation, not a bound
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "16"))
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", "2"))
+HOST_MIN_INTERVAL = float(os.getenv("HOST_MIN_INTERVAL", "1.0"))  # seconds between requests to one host
+SCRAPER_CACHE_DIR = os.getenv("SCRAPER_CACHE", "/tmp/scraper_cache")
+SCRAPER_CACHE_TTL = int(os.getenv("SCRAPER_CACHE_TTL", str(24 * 3600)))  # seconds before revalidation
 MODEL_NAME = os.getenv("MODEL_NAME", "all-MiniLM-L6-v2")
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "onnx")  # "onnx" or "torch"
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx2")  # safe on any x86-64 CPU
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/tmp/models")
+EMBED_DTYPE = os.getenv("EMBED_DTYPE", "fp32")  # torch backend: fp32, fp16, bf16 or int8
+
+
+# ============================================================
+# MODEL LOADING
+# ============================================================
+def _detect_device() -> str:
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+DEVICE = os.getenv("DEVICE") or _detect_device()
+
+
+def _load_onnx_model() -> SentenceTransformer:
+    """
+    Load an int8-quantized ONNX export of the model.
+    
+    The quantized file is exported once into MODEL_CACHE_DIR and reused
+    on subsequent starts (the Docker image ships it pre-exported).
+    """
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    
+    local_dir = os.path.join(
+        MODEL_CACHE_DIR, f"{MODEL_NAME.replace('/', '__')}-onnx-{ONNX_QUANTIZATION}"
+    )
+    file_name = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+    model_kwargs = {"file_name": file_name, "provider": "CPUExecutionProvider"}
+    
+    if not os.path.exists(local_dir):
+        print(f"🔧 Exporting quantized ONNX model ({ONNX_QUANTIZATION})...")
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        # Export into a private directory and rename it into place, so another
+        # process starting at the same time never loads a half-written model
+        tmp_dir = tempfile.mkdtemp(dir=MODEL_CACHE_DIR)
+        try:
+            base = SentenceTransformer(MODEL_NAME, backend="onnx")
+            base.save(tmp_dir)
+            export_dynamic_quantized_onnx_model(base, ONNX_QUANTIZATION, tmp_dir)
+            os.replace(tmp_dir, local_dir)
+        except OSError:
+            # Lost the race: another process already moved its export into place
+            if not os.path.exists(local_dir):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    return SentenceTransformer(local_dir, backend="onnx", model_kwargs=model_kwargs)
+
+
+def _load_torch_model() -> SentenceTransformer:
+    """Load the PyTorch model on DEVICE in the precision selected by EMBED_DTYPE"""
+    if EMBED_DTYPE in ("fp16", "bf16"):
+        dtype = torch.float16 if EMBED_DTYPE == "fp16" else torch.bfloat16
+        return SentenceTransformer(MODEL_NAME, device=DEVICE, model_kwargs={"torch_dtype": dtype})
+    
+    if EMBED_DTYPE == "int8":
+        # int8 weights for Linear layers; activations and embeddings stay fp32.
+        # Dynamic quantization only has CPU kernels.
+        model = SentenceTransformer(MODEL_NAME, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    return SentenceTransformer(MODEL_NAME, device=DEVICE)
+
+
+def load_model() -> SentenceTransformer:
+    # The quantized ONNX model targets CPU; on a GPU the PyTorch model is faster
+    if MODEL_BACKEND == "onnx" and DEVICE == "cpu":
+        try:
+            return _load_onnx_model()
+        except Exception as e:
+            print(f"⚠ ONNX backend unavailable ({e}), falling back to PyTorch")
+    return _load_torch_model()
+
 
 # Load model once at module level
-print(f"📦 Loading model: {MODEL_NAME}...")
-_model = SentenceTransformer(MODEL_NAME)
+print(f"📦 Loading model: {MODEL_NAME} ({MODEL_BACKEND}, {DEVICE})...")
+_model = load_model()
 print(f"✅ Model loaded!")
 
 
+# ============================================================
+# VECTOR MATH
+# ============================================================
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity of L2-normalized embeddings.
+    
+    Works on single vectors or row-wise on two (N, D) matrices. Uses
+    SimSIMD's SIMD kernels when installed, NumPy otherwise.
+    """
+    if simsimd is not None:
+        distances = simsimd.cosine(
+            np.ascontiguousarray(a, dtype=np.float32),
+            np.ascontiguousarray(b, dtype=np.float32),
+        )
+        return 1.0 - np.asarray(distances, dtype=np.float32)
+    return np.einsum('...i,...i->...', a, b)
+
+
 # ============================================================
 # GOOGLE SHEETS AUTH
 # ============================================================
+class OrjsonModel(JsonModel):
+    """JsonModel that parses API responses with orjson (large values.get bodies)"""
+    
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
+
+
+# The service object isn't thread-safe (httplib2), so cache one per thread
+_sheets_local = threading.local()
+
+
 def get_sheets_service():
+    service = getattr(_sheets_local, "service", None)
+    if service is not None:
+        return service
+    
     creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
     
     if not creds_json:
         raise ValueError("GOOGLE_CREDENTIALS_JSON environment variable not set.")
     
-    creds_dict = json.loads(creds_json)
+    creds_dict = orjson.loads(creds_json)
     credentials = service_account.Credentials.from_service_account_info(
         creds_dict,
         scopes=['https://www.googleapis.com/auth/spreadsheets']
     )
     
-    return build('sheets', 'v4', credentials=credentials)
+    _sheets_local.service = build(
+        'sheets', 'v4',
+        credentials=credentials,
+        model=OrjsonModel(),
+        static_discovery=True,
+        cache_discovery=False,
+    )
+    return _sheets_local.service
 
 
 # ============================================================
 # THRESHOLD LABELS
 # ============================================================
+# (lower bound, label), sorted by lower bound
+THRESHOLDS = [
+    (-math.inf, "🔴 Poor (<0.3)"),
+    (0.3, "🟠 Acceptable (0.3-0.39)"),
+    (0.4, "🟡 Good (0.4-0.59)"),
+    (0.6, "🟢 Excellent (0.6+)"),
+]
+_THRESHOLD_KEYS = [bound for bound, _ in THRESHOLDS]
+_THRESHOLD_LABELS = [label for _, label in THRESHOLDS]
+
+
 def get_threshold_label(score: Optional[float]) -> str:
     if score is None:
         return "N/A"
-    if score >= 0.6:
-        return "🟢 Excellent (0.6+)"
-    elif score >= 0.4:
-        return "🟡 Good (0.4-0.59)"
-    elif score >= 0.3:
-        return "🟠 Acceptable (0.3-0.39)"
-    else:
-        return "🔴 Poor (<0.3)"
+    return _THRESHOLD_LABELS[bisect.bisect_right(_THRESHOLD_KEYS, score) - 1]
 
 
 # ============================================================
@@ -100,23 +259,45 @@ class ContentScraper:
         r'checking\s*your\s*browser', r'blocked', r'rate\s*limit'
     ]
     
+    # All patterns in one alternation so a page is scanned once
+    ERROR_RE = re.compile('|'.join(ERROR_PATTERNS), re.I)
+    
     def __init__(self):
-        self.cache = {}
+        # Persistent cache: sha1(url) -> (etag, last_modified, text, fetched_at)
+        self.cache = Cache(SCRAPER_CACHE_DIR, size_limit=2 << 30)
         self.session = requests.Session()
         self.session.headers.update({
             'Accept': 'text/html,application/xhtml+xml',
             'Accept-Language': 'en-US,en;q=0.9',
         })
+        # Large pool so concurrent fetches reuse keep-alive connections
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Per-host limits keep parallel fetching polite to any single site
+        self._host_limits = defaultdict(lambda: threading.Semaphore(PER_HOST_CONCURRENCY))
+        self._host_next_request = {}
+        self._host_limits_lock = threading.Lock()
+    
+    def _host_limit(self, url: str) -> threading.Semaphore:
+        with self._host_limits_lock:
+            return self._host_limits[urlparse(url).netloc]
+    
+    def _wait_for_host(self, url: str):
+        """Space out requests to the same host by HOST_MIN_INTERVAL"""
+        host = urlparse(url).netloc
+        with self._host_limits_lock:
+            now = time.monotonic()
+            start = max(now, self._host_next_request.get(host, 0.0))
+            self._host_next_request[host] = start + HOST_MIN_INTERVAL
+        if start > now:
+            time.sleep(start - now)
     
     def _is_error_page(self, text: str) -> bool:
         """Check if content is an error page"""
         if not text:
             return True
-        text_lower = text.lower()[:500]
-        for pattern in self.ERROR_PATTERNS:
-            if re.search(pattern, text_lower, re.I):
-                return True
-        return False
+        return bool(self.ERROR_RE.search(text[:500]))
     
     def _validate_content(self, text: str) -> tuple[bool, str]:
         """Validate extracted content"""
@@ -134,6 +315,52 @@ class ContentScraper:
         
         return True, "Valid"
     
+    def _read_html(self, response: requests.Response) -> str:
+        """Read at most MAX_HTML_BYTES of a streamed response body"""
+        body = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            body += chunk
+            if len(body) >= MAX_HTML_BYTES:
+                break
+        return bytes(body[:MAX_HTML_BYTES]).decode(response.encoding or 'utf-8', errors='replace')
+    
+    def _run_trafilatura(self, html: str, no_fallback: bool) -> Optional[str]:
+        # This is the key difference - Trafilatura uses Google-like algorithms:
+        # - Text density analysis
+        # - Link density detection  
+        # - DOM structure parsing
+        # - Boilerplate pattern matching
+        return trafilatura.extract(
+            html,
+            include_comments=False,      # Exclude comments
+            include_tables=False,        # Exclude tables (often boilerplate)
+            no_fallback=no_fallback,     # Skip readability/justext fallbacks
+            favor_precision=True,        # Prefer precision over recall
+            deduplicate=True,            # Remove duplicate content
+        )
+    
+    def _extract(self, html: str) -> Optional[str]:
+        """
+        Extract main content using Trafilatura.
+        
+        Tries the fast extractor first and only falls back to the slower
+        readability/justext extractors when its output fails validation.
+        Results are cached by HTML hash so identical pages are extracted once.
+        """
+        html_key = 'html:' + hashlib.sha1(html.encode()).hexdigest()
+        text = self.cache.get(html_key)
+        if text is not None:
+            return text
+        
+        text = self._run_trafilatura(html, no_fallback=True)
+        is_valid, reason = self._validate_content(text)
+        if not is_valid and reason != "Error page detected":
+            text = self._run_trafilatura(html, no_fallback=False)
+        
+        if text:
+            self.cache.set(html_key, text, expire=SCRAPER_CACHE_TTL)
+        return text
+    
     def fetch(self, url: str) -> Optional[str]:
         """
         Fetch and extract main content from URL using Trafilatura.
@@ -149,38 +376,55 @@ class ContentScraper:
         if not url.startswith(('http://', 'https://')):
             url = f'https://{url}'
         
-        # Check cache
-        if url in self.cache:
-            return self.cache[url]
+        # Check cache - fresh entries are returned as-is, stale ones revalidated
+        key = hashlib.sha1(url.encode()).hexdigest()
+        cached = self.cache.get(key)
+        headers = {'User-Agent': random.choice(self.USER_AGENTS)}
+        
+        if cached:
+            etag, last_modified, cached_text, fetched_at = cached
+            if time.time() - fetched_at < SCRAPER_CACHE_TTL:
+                return cached_text
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
         
         try:
-            # Fetch HTML
-            self.session.headers['User-Agent'] = random.choice(self.USER_AGENTS)
-            response = self.session.get(url, timeout=20, allow_redirects=True)
-            response.raise_for_status()
-            
-            html = response.text
+            # Fetch HTML (streamed, so oversized pages are cut off early)
+            self._wait_for_host(url)
+            with self._host_limit(url), self.session.get(
+                url,
+                headers=headers,
+                timeout=(5, 15),
+                allow_redirects=True,
+                stream=True,
+            ) as response:
+                if cached and response.status_code == 304:
+                    self.cache[key] = (etag, last_modified, cached_text, time.time())
+                    return cached_text
+                
+                response.raise_for_status()
+                
+                content_type = response.headers.get('Content-Type', '')
+                if content_type and 'html' not in content_type.lower():
+                    print(f"    ⚠ Not HTML: {content_type}")
+                    return None
+                
+                html = self._read_html(response)
             
-            # Extract content using Trafilatura
-            # This is the key difference - Trafilatura uses Google-like algorithms:
-            # - Text density analysis
-            # - Link density detection  
-            # - DOM structure parsing
-            # - Boilerplate pattern matching
-            text = trafilatura.extract(
-                html,
-                include_comments=False,      # Exclude comments
-                include_tables=False,        # Exclude tables (often boilerplate)
-                no_fallback=False,           # Use fallback extraction if needed
-                favor_precision=True,        # Prefer precision over recall
-                deduplicate=True,            # Remove duplicate content
-            )
+            text = self._extract(html)
             
             # Validate
             is_valid, reason = self._validate_content(text)
             
             if is_valid:
-                self.cache[url] = text
+                self.cache[key] = (
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'),
+                    text,
+                    time.time(),
+                )
                 print(f"    ✅ Extracted {len(text)} chars, {len(text.split())} words")
                 return text
             else:
@@ -190,6 +434,49 @@ class ContentScraper:
         except Exception as e:
             print(f"    ⚠ Fetch error: {e}")
             return None
+    
+    @staticmethod
+    def _interleave_hosts(urls: list[str]) -> list[str]:
+        """
+        Order URLs round-robin by host.
+        
+        Workers sleep while a host's request interval runs out, so a long
+        run of one host's URLs would put every worker to sleep on it while
+        other hosts sit idle; interleaving keeps all hosts in flight.
+        """
+        by_host = defaultdict(list)
+        for url in urls:
+            by_host[urlparse(url).netloc].append(url)
+        return [
+            url
+            for group in itertools.zip_longest(*by_host.values())
+            for url in group
+            if url is not None
+        ]
+    
+    def fetch_many(
+        self,
+        urls: list[str],
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> dict[str, Optional[str]]:
+        """
+        Fetch many URLs concurrently.
+        
+        Duplicate URLs are fetched once. Returns a mapping of each input URL
+        to its extracted content (None on failure).
+        """
+        unique_urls = self._interleave_hosts(list(dict.fromkeys(urls)))
+        results = {}
+        
+        with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+            for done, (url, text) in enumerate(
+                zip(unique_urls, executor.map(self.fetch, unique_urls)), start=1
+            ):
+                results[url] = text
+                if progress_callback:
+                    progress_callback(done, len(unique_urls))
+        
+        return results
 
 
 # ============================================================
@@ -199,26 +486,39 @@ class SimilarityCalculator:
     def __init__(self):
         self.model = _model
         self.scraper = ContentScraper()
+        self.max_chars = self.model.max_seq_length * CHARS_PER_TOKEN
     
-    def calculate(self, url1: str, url2: str) -> Optional[float]:
-        content1 = self.scraper.fetch(url1)
-        content2 = self.scraper.fetch(url2)
+    def _truncate(self, text: str) -> str:
+        """
+        Cut text to roughly the model's context window.
         
-        if not content1 or not content2:
-            return None
+        The model truncates to max_seq_length tokens anyway, but the
+        tokenizer still walks the whole string first. The cut is a
+        character estimate: text with many long words can lose a few
+        tokens the model would otherwise have seen.
+        """
+        return text[:self.max_chars]
+    
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        Normalized embeddings for many texts at once.
         
-        try:
-            # Encode both texts
-            emb1 = self.model.encode([content1], normalize_embeddings=True)[0]
-            emb2 = self.model.encode([content2], normalize_embeddings=True)[0]
-            
-            # Cosine similarity (dot product of normalized vectors)
-            similarity = float(np.dot(emb1, emb2))
-            return round(np.clip(similarity, -1.0, 1.0), 4)
-            
-        except Exception as e:
-            print(f"    ⚠ Embedding error: {e}")
-            return None
+        All texts go through a single encode call so the model can batch
+        them together instead of paying a forward pass per row.
+        """
+        # encode() already length-sorts its input before batching and restores
+        # the original order afterwards, so similar-length texts share padding
+        return self.model.encode(
+            [self._truncate(text) for text in texts],
+            batch_size=64,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
+
+# Shared across jobs so HTTP connections and the URL cache stay warm
+_calculator = SimilarityCalculator()
 
 
 # ============================================================
@@ -227,6 +527,7 @@ class SimilarityCalculator:
 class CosineCalculatorService:
     
     @staticmethod
+    @lru_cache(maxsize=1024)
     def col_letter_to_index(letter: str) -> int:
         result = 0
         for char in letter.upper():
@@ -234,6 +535,7 @@ class CosineCalculatorService:
         return result - 1
     
     @staticmethod
+    @lru_cache(maxsize=1024)
     def col_index_to_letter(index: int) -> str:
         result = ""
         index += 1
@@ -242,6 +544,40 @@ class CosineCalculatorService:
             result = chr(65 + remainder) + result
         return result
     
+    @staticmethod
+    def warm_up():
+        """Run one tiny encode so lazy model/BLAS initialization happens now"""
+        _calculator.embed(["warm up"])
+    
+    @staticmethod
+    def validate_columns(
+        article_col: str,
+        target_col: str,
+        output_col: str,
+        threshold_col: Optional[str]
+    ):
+        """
+        Cheap request checks (no I/O) so bad jobs fail before any work starts.
+        Raises ValueError describing the first problem found.
+        """
+        to_index = CosineCalculatorService.col_letter_to_index
+        
+        for name, col in (("article_column", article_col), ("target_column", target_col)):
+            if to_index(col) > to_index("Z"):
+                raise ValueError(f"{name} '{col}' is outside the A-Z range that is read.")
+        
+        input_cols = {article_col.upper(), target_col.upper()}
+        output_idx = to_index(output_col)
+        threshold_idx = to_index(threshold_col) if threshold_col else output_idx + 1
+        threshold_letter = CosineCalculatorService.col_index_to_letter(threshold_idx)
+        
+        if output_col.upper() in input_cols:
+            raise ValueError(f"output_column '{output_col}' would overwrite an input column.")
+        if threshold_letter in input_cols:
+            raise ValueError(f"threshold column '{threshold_letter}' would overwrite an input column.")
+        if threshold_idx == output_idx:
+            raise ValueError("threshold_column must differ from output_column.")
+    
     @staticmethod
     def process_spreadsheet(
         spreadsheet_id: str,
@@ -253,8 +589,10 @@ class CosineCalculatorService:
         progress_callback: Callable[[dict], None]
     ) -> dict:
         
+        CosineCalculatorService.validate_columns(article_col, target_col, output_col, threshold_col)
+        
         service = get_sheets_service()
-        calculator = SimilarityCalculator()
+        calculator = _calculator
         
         article_idx = CosineCalculatorService.col_letter_to_index(article_col)
         target_idx = CosineCalculatorService.col_letter_to_index(target_col)
@@ -305,60 +643,98 @@ class CosineCalculatorService:
             "message": f"Processing {total} rows..."
         })
         
-        updates = []
-        success = 0
-        failed = 0
+        # Phase 1: fetch content for every URL concurrently
+        def report_fetch(done: int, count: int):
+            progress_callback({
+                "stage": "fetching",
+                "total": count,
+                "current": done,
+                "message": f"Fetching URLs ({done}/{count})"
+            })
         
-        for idx, (row_num, article_url, target_url) in enumerate(rows_to_process):
-            print(f"\n[{idx+1}/{total}] Row {row_num}")
-            print(f"  Article: {article_url[:50]}...")
-            print(f"  Target: {target_url[:50]}...")
-            
+        contents = calculator.scraper.fetch_many(
+            [url for _, article_url, target_url in rows_to_process for url in (article_url, target_url)],
+            progress_callback=report_fetch
+        )
+        
+        # Phase 2: embed each unique page once, then score every row
+        valid_urls = [url for url, text in contents.items() if text]
+        scores = {}
+        if valid_urls:
             progress_callback({
-                "stage": "processing",
+                "stage": "embedding",
                 "total": total,
-                "current": idx + 1,
-                "row": row_num,
-                "message": f"Processing row {row_num} ({idx+1}/{total})"
+                "current": total,
+                "message": f"Embedding {len(valid_urls)} unique pages..."
             })
             
-            similarity = calculator.calculate(article_url, target_url)
-            
-            if similarity is not None:
-                label = get_threshold_label(similarity)
-                print(f"  ✅ Score: {similarity} - {label}")
+            try:
+                embeddings = calculator.embed([contents[url] for url in valid_urls])
+                emb_by_url = dict(zip(valid_urls, embeddings))
                 
+                scored_rows = [
+                    (row_num, article_url, target_url)
+                    for row_num, article_url, target_url in rows_to_process
+                    if article_url in emb_by_url and target_url in emb_by_url
+                ]
+                if scored_rows:
+                    # (N, D) article and target matrices -> N scores in one call
+                    articles = np.stack([emb_by_url[article_url] for _, article_url, _ in scored_rows])
+                    targets = np.stack([emb_by_url[target_url] for _, _, target_url in scored_rows])
+                    similarities = np.clip(cosine_similarity(articles, targets), -1.0, 1.0).round(4)
+                    scores = {
+                        row_num: float(similarity)
+                        for (row_num, _, _), similarity in zip(scored_rows, similarities)
+                    }
+            except Exception as e:
+                print(f"  ⚠ Embedding error: {e}")
+        
+        # Phase 3: write all results back to the sheet in one request
+        adjacent = threshold_idx == output_idx + 1
+        updates = []
+        success = 0
+        failed = 0
+        
+        # Range prefixes are loop-invariant; only the row number changes
+        output_prefix = f"'{sheet_name}'!{output_col}"
+        threshold_prefix = f"'{sheet_name}'!{threshold_letter}"
+        
+        def add_result(row_num: int, score_text: str, label: str):
+            if adjacent:
                 updates.append({
-                    'range': f"'{sheet_name}'!{output_col}{row_num}",
-                    'values': [[f"{similarity:.4f}"]]
-                })
-                updates.append({
-                    'range': f"'{sheet_name}'!{threshold_letter}{row_num}",
-                    'values': [[label]]
+                    'range': f"{output_prefix}{row_num}:{threshold_letter}{row_num}",
+                    'values': [[score_text, label]]
                 })
-                success += 1
             else:
-                print(f"  ❌ Failed")
                 updates.append({
-                    'range': f"'{sheet_name}'!{output_col}{row_num}",
-                    'values': [["N/A"]]
+                    'range': f"{output_prefix}{row_num}",
+                    'values': [[score_text]]
                 })
                 updates.append({
-                    'range': f"'{sheet_name}'!{threshold_letter}{row_num}",
-                    'values': [["N/A"]]
+                    'range': f"{threshold_prefix}{row_num}",
+                    'values': [[label]]
                 })
-                failed += 1
-            
-            if len(updates) >= 10:
-                service.spreadsheets().values().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body={'valueInputOption': 'USER_ENTERED', 'data': updates}
-                ).execute()
-                updates = []
+        
+        for row_num, _, _ in rows_to_process:
+            similarity = scores.get(row_num)
             
-            time.sleep(random.uniform(0.5, 1.5))
+            if similarity is not None:
+                label = get_threshold_label(similarity)
+                print(f"  ✅ Row {row_num} score: {similarity} - {label}")
+                add_result(row_num, f"{similarity:.4f}", label)
+                success += 1
+            else:
+                print(f"  ❌ Row {row_num} failed")
+                add_result(row_num, "N/A", "N/A")
+                failed += 1
         
         if updates:
+            progress_callback({
+                "stage": "writing",
+                "total": total,
+                "current": total,
+                "message": f"Writing {total} results to {sheet_name}..."
+            })
             service.spreadsheets().values().batchUpdate(
                 spreadsheetId=spreadsheet_id,
                 body={'valueInputOption': 'USER_ENTERED', 'data': updates}
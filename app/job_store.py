@@ -1,7 +1,13 @@
+from collections import deque
 from datetime import datetime
 from enum import Enum
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional
+import os
 import threading
+import time
+
+import orjson
+import redis
 
 
 class JobStatus(str, Enum):
@@ -11,20 +17,73 @@ class JobStatus(str, Enum):
     FAILED = "failed"
 
 
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.PROCESSING)
+
+
+class ThrottledProgress:
+    """
+    Progress callback wrapper that forwards at most one update per
+    min_interval seconds. The first update of each stage is always
+    forwarded, so no phase is skipped.
+    """
+    
+    def __init__(self, callback: Callable[[dict], None], min_interval: float = 0.2):
+        self.callback = callback
+        self.min_interval = min_interval
+        self._last = 0.0
+        self._stage = None
+    
+    def __call__(self, prog: dict):
+        now = time.monotonic()
+        stage = prog.get("stage")
+        if stage == self._stage and now - self._last < self.min_interval:
+            return
+        self._stage = stage
+        self._last = now
+        self.callback(prog)
+
+
 class JobStore:
     """
     In-memory job storage.
+    Job records are never mutated in place: every update stores a new dict
+    with a single (GIL-atomic) assignment, so reads and status updates need
+    no lock. Finished jobs older than max_age_hours, and the oldest finished
+    jobs beyond max_jobs, are dropped when new jobs are created; queued and
+    processing jobs are never dropped.
     For production with multiple workers, use Redis instead.
     """
     
-    def __init__(self):
+    def __init__(self, max_jobs: int = 10_000, max_age_hours: int = 24):
+        # Insertion order == creation order, so listing needs no sort
         self._jobs: Dict[str, Dict[str, Any]] = {}
-        self._lock = threading.Lock()
+        self._expiry: deque = deque()  # (expires_at, job_id) in creation order
+        self._max_jobs = max_jobs
+        self._ttl = max_age_hours * 3600
+        self._active: Dict[str, str] = {}  # request_key -> job_id
+        self._lock = threading.Lock()  # guards creation/eviction and _active
+    
+    def _evict(self):
+        now = time.monotonic()
+        for _ in range(len(self._expiry)):
+            expires_at, job_id = self._expiry[0]
+            if expires_at > now and len(self._jobs) < self._max_jobs:
+                break
+            
+            self._expiry.popleft()
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] in ACTIVE_STATUSES:
+                # Still queued/running: keep it, look again on a later pass
+                self._expiry.append((expires_at, job_id))
+            else:
+                self._jobs.pop(job_id, None)
     
-    def create_job(self, job_id: str, metadata: dict) -> dict:
+    def create_job(self, job_id: str, metadata: dict, request_key: Optional[str] = None) -> dict:
+        # In-memory claims die with the process, so request_key isn't needed
         with self._lock:
+            self._evict()
             now = datetime.utcnow().isoformat()
-            self._jobs[job_id] = {
+            job = {
                 "status": JobStatus.QUEUED,
                 "metadata": metadata,
                 "progress": None,
@@ -33,7 +92,13 @@ class JobStore:
                 "created_at": now,
                 "updated_at": now
             }
-            return self._jobs[job_id]
+            self._jobs[job_id] = job
+            self._expiry.append((time.monotonic() + self._ttl, job_id))
+            return job
+    
+    def delete_job(self, job_id: str):
+        """Drop a job that was never scheduled"""
+        self._jobs.pop(job_id, None)
     
     def get_job(self, job_id: str) -> Optional[dict]:
         return self._jobs.get(job_id)
@@ -46,43 +111,264 @@ class JobStore:
         result: dict = None,
         error: str = None
     ):
+        # Finished jobs are final, and are the only ones _evict drops, so
+        # this read-then-assign can never re-insert an evicted job
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] not in ACTIVE_STATUSES:
+            return
+        
+        job = {**job, "status": status, "updated_at": datetime.utcnow().isoformat()}
+        
+        if progress is not None:
+            job["progress"] = progress
+        if result is not None:
+            job["result"] = result
+        if error is not None:
+            job["error"] = error
+        
+        self._jobs[job_id] = job
+    
+    def claim_request(self, request_key: str, job_id: str) -> Optional[str]:
+        """
+        Register job_id as the active job for request_key.
+        Returns the id of an identical job that is still queued/processing
+        instead, if there is one.
+        """
         with self._lock:
-            if job_id not in self._jobs:
-                return
-            
-            self._jobs[job_id]["status"] = status
-            self._jobs[job_id]["updated_at"] = datetime.utcnow().isoformat()
-            
-            if progress is not None:
-                self._jobs[job_id]["progress"] = progress
-            if result is not None:
-                self._jobs[job_id]["result"] = result
-            if error is not None:
-                self._jobs[job_id]["error"] = error
+            existing = self._active.get(request_key)
+            if existing:
+                job = self._jobs.get(existing)
+                if job and job["status"] in ACTIVE_STATUSES:
+                    return existing
+            self._active[request_key] = job_id
+            return None
+    
+    def refresh_claim(self, request_key: str, job_id: str, hold: bool = False):
+        """In-memory claims don't expire; nothing to refresh"""
+    
+    def release_request(self, request_key: str, job_id: str):
+        with self._lock:
+            if self._active.get(request_key) == job_id:
+                del self._active[request_key]
     
     def list_jobs(self, limit: int = 20) -> list:
         """List recent jobs"""
-        jobs = list(self._jobs.items())
-        jobs.sort(key=lambda x: x[1]["created_at"], reverse=True)
+        jobs = list(self._jobs.items())[-limit:]
         return [
             {"job_id": jid, **data} 
-            for jid, data in jobs[:limit]
+            for jid, data in reversed(jobs)
         ]
+
+
+class RedisJobStore:
+    """
+    Redis-backed job storage, shared by all workers.
+    Each job is a hash at job:{job_id} that expires after max_age_hours;
+    jobs:index is a sorted set of job ids by creation time for listing.
+    active:{request_key} points at the queued/running job for a request;
+    it expires after claim_ttl seconds unless refreshed (by status updates
+    and by the web process while a job waits for a slot), so a job lost to
+    a crash or redeploy only blocks retries briefly. Jobs handed to a
+    durable queue (Celery) hold their claim for max_age_hours instead.
+    Calls are blocking network round trips: keep them off the event loop.
+    """
     
-    def cleanup_old_jobs(self, max_age_hours: int = 24):
-        """Remove jobs older than max_age_hours"""
-        with self._lock:
-            now = datetime.utcnow()
-            to_delete = []
-            for job_id, job in self._jobs.items():
-                created = datetime.fromisoformat(job["created_at"])
-                age = (now - created).total_seconds() / 3600
-                if age > max_age_hours:
-                    to_delete.append(job_id)
-            
-            for job_id in to_delete:
-                del self._jobs[job_id]
+    JSON_FIELDS = ("metadata", "progress", "result")
+    INDEX_KEY = "jobs:index"
+    
+    # Check and write in one step: a hash that expires between the two
+    # must not be recreated as a partial hash with no TTL, and a finished
+    # job must not be flipped back by a late update (same rule as JobStore)
+    # KEYS[1] = job hash; ARGV = job id, claim TTL, field/value pairs
+    UPDATE_SCRIPT = """
+    local status = redis.call('HGET', KEYS[1], 'status')
+    if status ~= 'queued' and status ~= 'processing' then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+    local request_key = redis.call('HGET', KEYS[1], 'request_key')
+    if request_key then
+        local claim = 'active:' .. request_key
+        if redis.call('GET', claim) == ARGV[1] then
+            redis.call('EXPIRE', claim, ARGV[2])
+        end
+    end
+    return 1
+    """
+    
+    # KEYS[1] = claim key; ARGV = job id, claim TTL. A claimed job whose
+    # record is missing counts as active, like a queued one.
+    CLAIM_SCRIPT = """
+    local existing = redis.call('GET', KEYS[1])
+    if existing then
+        local status = redis.call('HGET', 'job:' .. existing, 'status')
+        if not status or status == 'queued' or status == 'processing' then
+            return existing
+        end
+    end
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return false
+    """
+    
+    # KEYS[1] = claim key; ARGV = job id, TTL
+    REFRESH_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    
+    # KEYS[1] = claim key; ARGV[1] = job id
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+    
+    def __init__(self, url: str, max_age_hours: int = 24, claim_ttl: int = 600):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._ttl = max_age_hours * 3600
+        self._claim_ttl = claim_ttl
+        self._update = self._redis.register_script(self.UPDATE_SCRIPT)
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+        self._refresh = self._redis.register_script(self.REFRESH_SCRIPT)
+        self._release = self._redis.register_script(self.RELEASE_SCRIPT)
+    
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+    
+    @staticmethod
+    def _claim_key(request_key: str) -> str:
+        return f"active:{request_key}"
+    
+    def _decode(self, data: dict) -> dict:
+        job = {
+            "status": data["status"],
+            "error": data.get("error") or None,
+            "created_at": data["created_at"],
+            "updated_at": data["updated_at"],
+        }
+        for field in self.JSON_FIELDS:
+            raw = data.get(field)
+            job[field] = orjson.loads(raw) if raw else None
+        return job
+    
+    def create_job(self, job_id: str, metadata: dict, request_key: Optional[str] = None) -> dict:
+        """request_key lets progress updates keep the job's claim alive"""
+        now = datetime.utcnow().isoformat()
+        key = self._key(job_id)
+        fields = {
+            "status": JobStatus.QUEUED.value,
+            "metadata": orjson.dumps(metadata),
+            "created_at": now,
+            "updated_at": now,
+        }
+        if request_key:
+            fields["request_key"] = request_key
+        
+        pipe = self._redis.pipeline()
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, self._ttl)
+        pipe.zadd(self.INDEX_KEY, {job_id: time.time()})
+        pipe.execute()
+        
+        return {
+            "status": JobStatus.QUEUED,
+            "metadata": metadata,
+            "progress": None,
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+    
+    def delete_job(self, job_id: str):
+        """Drop a job that was never scheduled"""
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key(job_id))
+        pipe.zrem(self.INDEX_KEY, job_id)
+        pipe.execute()
+    
+    def get_job(self, job_id: str) -> Optional[dict]:
+        data = self._redis.hgetall(self._key(job_id))
+        return self._decode(data) if data else None
+    
+    def update_status(
+        self, 
+        job_id: str, 
+        status: JobStatus, 
+        progress: dict = None,
+        result: dict = None,
+        error: str = None
+    ):
+        fields = {
+            "status": JobStatus(status).value,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+        if progress is not None:
+            fields["progress"] = orjson.dumps(progress)
+        if result is not None:
+            fields["result"] = orjson.dumps(result)
+        if error is not None:
+            fields["error"] = error
+        
+        args = [job_id, self._claim_ttl, *(item for pair in fields.items() for item in pair)]
+        self._update(keys=[self._key(job_id)], args=args)
+    
+    def claim_request(self, request_key: str, job_id: str) -> Optional[str]:
+        """
+        Register job_id as the active job for request_key.
+        Returns the id of an identical job that is still queued/processing
+        instead, if there is one.
+        """
+        return self._claim(keys=[self._claim_key(request_key)], args=[job_id, self._claim_ttl])
+    
+    def refresh_claim(self, request_key: str, job_id: str, hold: bool = False):
+        """
+        Extend job_id's claim on request_key by claim_ttl, or with hold=True
+        for the job's whole lifetime (it sits on a queue that survives
+        restarts, so no heartbeat is needed).
+        """
+        ttl = self._ttl if hold else self._claim_ttl
+        self._refresh(keys=[self._claim_key(request_key)], args=[job_id, ttl])
+    
+    def release_request(self, request_key: str, job_id: str):
+        self._release(keys=[self._claim_key(request_key)], args=[job_id])
+    
+    def list_jobs(self, limit: int = 20) -> list:
+        """List recent jobs"""
+        # Drop index entries whose job hash has already expired
+        self._redis.zremrangebyscore(self.INDEX_KEY, "-inf", time.time() - self._ttl)
+        job_ids = self._redis.zrevrange(self.INDEX_KEY, 0, limit - 1)
+        
+        pipe = self._redis.pipeline()
+        for job_id in job_ids:
+            pipe.hgetall(self._key(job_id))
+        
+        return [
+            {"job_id": jid, **self._decode(data)} 
+            for jid, data in zip(job_ids, pipe.execute())
+            if data
+        ]
+
+
+def create_job_store():
+    """Use Redis when REDIS_URL is set, otherwise keep jobs in memory"""
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        return RedisJobStore(redis_url)
+    return JobStore()
 
 
 # Singleton instance
-job_store = JobStore()
+job_store = create_job_store()
+
+
+def report_progress(job_id: str, prog: dict):
+    """
+    Progress callback for a job. Module-level (bind job_id with
+    functools.partial) so it stays picklable for worker processes.
+    """
+    job_store.update_status(job_id, JobStatus.PROCESSING, progress=prog)
@@ -1,26 +1,157 @@
 import os
-import uuid
+import re
+import base64
 import asyncio
+import hashlib
+import logging
+import multiprocessing
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from pydantic import BaseModel
+import msgspec
+import orjson
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, field_validator
 
 from .calculator import CosineCalculatorService
-from .job_store import job_store, JobStatus
+from .job_store import job_store, JobStatus, RedisJobStore, ThrottledProgress, report_progress
+from .tasks import CELERY_BROKER_URL, process_spreadsheet_task
+
+logger = logging.getLogger(__name__)
+
+# Dedicated pool for spreadsheet jobs, so they don't compete with the
+# default executor that FastAPI/asyncio use for other blocking calls.
+# "process" runs jobs in separate processes (one model copy each) so
+# concurrent jobs don't share a GIL; progress then comes back over a queue.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(os.cpu_count() or 1)))
+JOB_EXECUTOR = os.getenv("JOB_EXECUTOR", "thread")  # "thread" or "process"
+job_pool: Optional[Executor] = None
+progress_queue = None  # multiprocessing queue of (job_id, progress), process mode only
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Jobs beyond the pool size wait here, visibly "queued", instead of piling
+# up inside the executor while reported as "processing"
+job_slots = asyncio.Semaphore(JOB_WORKERS)
+
+# Jobs waiting for a slot (or in a long phase) don't update the store, so
+# their duplicate-request claim is refreshed on this interval instead.
+# Must stay well below the Redis claim TTL (10 minutes).
+CLAIM_REFRESH_INTERVAL = 60
+
+# Wakes /status/{job_id}/stream listeners when a job changes in this process.
+# Updates from other workers (Celery, other uvicorn processes) are picked up
+# by the periodic re-check instead.
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "5"))
+job_events: Dict[str, asyncio.Event] = {}
+job_listeners: Dict[str, int] = {}  # open streams per job; the event goes with the last one
+
+
+async def store_call(method, *args, **kwargs):
+    """
+    Call a job_store method from the event loop. Redis calls are network
+    round trips, so they run in the threadpool; in-memory calls are cheap
+    and stay on the loop.
+    """
+    if isinstance(job_store, RedisJobStore):
+        return await run_in_threadpool(method, *args, **kwargs)
+    return method(*args, **kwargs)
+
+
+async def keep_claim(request_key: str, job_id: str):
+    """Refresh a job's request claim until cancelled"""
+    while True:
+        await asyncio.sleep(CLAIM_REFRESH_INTERVAL)
+        await store_call(job_store.refresh_claim, request_key, job_id)
+
+
+def notify_job(job_id: str):
+    """Wake all stream listeners for a job (event loop thread only)"""
+    event = job_events.get(job_id)
+    if event:
+        event.set()
+        event.clear()
+
+
+def report_local_progress(job_id: str, prog: dict):
+    """
+    Progress callback for jobs running in this process's job pool.
+    The store write stays on the worker thread (update_status ignores
+    finished jobs, so late updates are harmless); only waking stream
+    listeners, which are loop-owned, is handed to the event loop.
+    """
+    report_progress(job_id, prog)
+    event_loop.call_soon_threadsafe(notify_job, job_id)
+
+
+def queue_progress(queue, job_id: str, prog: dict):
+    """Progress callback inside worker processes"""
+    queue.put((job_id, prog))
+
+
+def run_job_in_process(queue, job_id: str, *args):
+    """Job entry point inside a worker process; progress goes back over queue"""
+    progress = ThrottledProgress(partial(queue_progress, queue, job_id))
+    return CosineCalculatorService.process_spreadsheet(*args, progress)
+
+
+async def forward_progress(queue):
+    """Apply progress sent by worker processes to the job store"""
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, queue.get)
+        if item is None:
+            return
+        
+        job_id, prog = item
+        await store_call(report_progress, job_id, prog)
+        notify_job(job_id)
+
 
 # ============================================================
 # LIFESPAN - Initialize/cleanup resources
 # ============================================================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global job_pool, progress_queue, event_loop
+    
     # Startup
     print("🚀 Starting Cosine Similarity API...")
+    event_loop = asyncio.get_running_loop()
+    if CELERY_BROKER_URL and not isinstance(job_store, RedisJobStore):
+        raise RuntimeError("CELERY_BROKER_URL requires REDIS_URL so workers can report job status.")
+    
+    if JOB_EXECUTOR == "process":
+        # spawn: forking a process that already runs threads and an ONNX/torch
+        # session is unsafe
+        mp_context = multiprocessing.get_context("spawn")
+        manager = mp_context.Manager()
+        progress_queue = manager.Queue()
+        job_pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=mp_context)
+        forwarder = asyncio.create_task(forward_progress(progress_queue))
+    else:
+        job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+    
+    # Pay for worker start-up and first-inference initialization now rather
+    # than on the first job
+    await asyncio.gather(*(
+        event_loop.run_in_executor(job_pool, CosineCalculatorService.warm_up)
+        for _ in range(JOB_WORKERS)
+    ))
+    print("🔥 Job pool warmed up")
+    
     yield
     # Shutdown
     print("👋 Shutting down...")
+    job_pool.shutdown(wait=False, cancel_futures=True)
+    if progress_queue is not None:
+        progress_queue.put(None)
+        await forwarder
+        manager.shutdown()
 
 
 # ============================================================
@@ -30,13 +161,18 @@ app = FastAPI(
     title="Cosine Similarity API",
     description="Calculate semantic similarity between article and target URLs",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 
 # ============================================================
 # REQUEST/RESPONSE MODELS
 # ============================================================
+SPREADSHEET_ID_RE = re.compile(r"^[A-Za-z0-9_-]{20,}$")
+COLUMN_RE = re.compile(r"^[A-Z]{1,3}$")
+
+
 class WebhookRequest(BaseModel):
     spreadsheet_id: str
     sheet_name: str = "Sheet1"
@@ -45,6 +181,36 @@ class WebhookRequest(BaseModel):
     output_column: str = "C"
     threshold_column: Optional[str] = None  # Auto: next to output
     
+    @field_validator("spreadsheet_id")
+    @classmethod
+    def check_spreadsheet_id(cls, value: str) -> str:
+        value = value.strip()
+        if not SPREADSHEET_ID_RE.match(value):
+            raise ValueError("must be a Google Sheets ID (20+ letters, digits, '-' or '_')")
+        return value
+    
+    @field_validator("sheet_name")
+    @classmethod
+    def check_sheet_name(cls, value: str) -> str:
+        if not value.strip():
+            raise ValueError("must not be empty")
+        return value
+    
+    @field_validator("article_column", "target_column", "output_column", "threshold_column")
+    @classmethod
+    def check_column(cls, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return value
+        value = value.strip().upper()
+        if not COLUMN_RE.match(value):
+            raise ValueError("must be a column letter like 'A' or 'AB'")
+        return value
+    
+    def request_key(self) -> str:
+        """Identifies requests that would do exactly the same work"""
+        raw = "|".join(str(value) for value in self.model_dump().values())
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+    
     class Config:
         json_schema_extra = {
             "example": {
@@ -57,13 +223,15 @@ class WebhookRequest(BaseModel):
         }
 
 
-class JobResponse(BaseModel):
+# Responses are built from our own job store, so they skip Pydantic
+# validation and are encoded directly by msgspec
+class JobResponse(msgspec.Struct, kw_only=True):
     job_id: str
     status: str
     message: str
 
 
-class StatusResponse(BaseModel):
+class StatusResponse(msgspec.Struct, kw_only=True):
     job_id: str
     status: str
     progress: Optional[dict] = None
@@ -73,35 +241,71 @@ class StatusResponse(BaseModel):
     updated_at: str
 
 
+def msgspec_response(
+    content: msgspec.Struct,
+    status_code: int = 200,
+    headers: Optional[dict] = None
+) -> Response:
+    return Response(
+        content=msgspec.json.encode(content),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/json"
+    )
+
+
 # ============================================================
 # BACKGROUND TASK
 # ============================================================
-async def process_spreadsheet_job(job_id: str, request: WebhookRequest):
+async def process_spreadsheet_job(job_id: str, request: WebhookRequest, request_key: str):
     """Background task that processes the spreadsheet"""
+    heartbeat = asyncio.create_task(keep_claim(request_key, job_id))
+    try:
+        await job_slots.acquire()
+    except BaseException:
+        heartbeat.cancel()
+        raise
+    
     try:
-        job_store.update_status(job_id, JobStatus.PROCESSING, progress={"stage": "initializing"})
+        await store_call(
+            job_store.update_status, job_id, JobStatus.PROCESSING, progress={"stage": "initializing"}
+        )
+        notify_job(job_id)
         
-        # Run in thread pool (CPU-bound + blocking I/O)
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            CosineCalculatorService.process_spreadsheet,
+        loop = asyncio.get_running_loop()
+        job_args = (
             request.spreadsheet_id,
             request.sheet_name,
             request.article_column,
             request.target_column,
             request.output_column,
             request.threshold_column,
-            lambda prog: job_store.update_status(job_id, JobStatus.PROCESSING, progress=prog)
         )
         
-        job_store.update_status(job_id, JobStatus.COMPLETED, result=result)
+        # Run in the dedicated job pool (CPU-bound + blocking I/O)
+        if progress_queue is not None:
+            result = await loop.run_in_executor(
+                job_pool, run_job_in_process, progress_queue, job_id, *job_args
+            )
+        else:
+            result = await loop.run_in_executor(
+                job_pool,
+                CosineCalculatorService.process_spreadsheet,
+                *job_args,
+                ThrottledProgress(partial(report_local_progress, job_id))
+            )
+        
+        await store_call(job_store.update_status, job_id, JobStatus.COMPLETED, result=result)
         
     except Exception as e:
-        job_store.update_status(job_id, JobStatus.FAILED, error=str(e))
-        print(f"❌ Job {job_id} failed: {e}")
-        import traceback
-        traceback.print_exc()
+        await store_call(job_store.update_status, job_id, JobStatus.FAILED, error=str(e))
+        logger.exception("❌ Job %s failed", job_id)
+    
+    finally:
+        job_slots.release()
+        heartbeat.cancel()
+        await store_call(job_store.release_request, request_key, job_id)
+        notify_job(job_id)
 
 
 # ============================================================
@@ -123,50 +327,157 @@ async def health():
     return {"status": "healthy"}
 
 
-@app.post("/webhook", response_model=JobResponse)
+@app.post("/webhook", response_class=Response, status_code=202)
 async def create_job(request: WebhookRequest, background_tasks: BackgroundTasks):
     """
     Receive webhook from n8n, start processing job.
-    Returns immediately with job_id for status polling.
+    Returns 202 Accepted immediately, with the status URL in Location.
     """
-    job_id = str(uuid.uuid4())[:8]
+    try:
+        CosineCalculatorService.validate_columns(
+            request.article_column,
+            request.target_column,
+            request.output_column,
+            request.threshold_column
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    # 12 URL-safe chars = 72 random bits
+    job_id = base64.urlsafe_b64encode(os.urandom(9)).decode()
+    request_key = request.request_key()
     
-    # Create job entry
-    job_store.create_job(job_id, {
+    # Create the job before claiming, so a claim never points at a job
+    # that doesn't exist (yet)
+    await store_call(job_store.create_job, job_id, {
         "spreadsheet_id": request.spreadsheet_id,
         "sheet_name": request.sheet_name
-    })
+    }, request_key)
     
-    # Schedule background processing
-    background_tasks.add_task(process_spreadsheet_job, job_id, request)
+    # An identical job is already queued/running - point the caller at it
+    existing_id = await store_call(job_store.claim_request, request_key, job_id)
+    if existing_id:
+        await store_call(job_store.delete_job, job_id)
+        existing = await store_call(job_store.get_job, existing_id)
+        status = JobStatus(existing["status"]) if existing else JobStatus.QUEUED
+        return msgspec_response(
+            JobResponse(
+                job_id=existing_id,
+                status=status.value,
+                message=f"Identical job already in progress. Poll /status/{existing_id} for progress."
+            ),
+            status_code=202,
+            headers={"Location": f"/status/{existing_id}"}
+        )
+    
+    # Schedule processing on a Celery worker if configured, in-process otherwise
+    try:
+        if CELERY_BROKER_URL:
+            # The broker keeps the task across restarts: hold the claim
+            # until a worker picks it up and its updates take over
+            await store_call(job_store.refresh_claim, request_key, job_id, hold=True)
+            # Publishing talks to the broker: keep it off the event loop
+            await run_in_threadpool(
+                process_spreadsheet_task.delay, job_id, request.model_dump(), request_key
+            )
+        else:
+            background_tasks.add_task(process_spreadsheet_job, job_id, request, request_key)
+    except Exception as e:
+        # Don't leave a claimed job behind that will never run
+        logger.exception("❌ Could not schedule job %s", job_id)
+        await store_call(job_store.update_status, job_id, JobStatus.FAILED, error=f"Could not schedule job: {e}")
+        await store_call(job_store.release_request, request_key, job_id)
+        raise HTTPException(status_code=503, detail="Could not schedule job, try again later")
     
-    return JobResponse(
-        job_id=job_id,
-        status="queued",
-        message=f"Job created. Poll /status/{job_id} for progress."
+    return msgspec_response(
+        JobResponse(
+            job_id=job_id,
+            status=JobStatus.QUEUED.value,
+            message=f"Job created. Poll /status/{job_id} for progress."
+        ),
+        status_code=202,
+        headers={"Location": f"/status/{job_id}"}
     )
 
 
-@app.get("/status/{job_id}", response_model=StatusResponse)
-async def get_status(job_id: str):
-    """Get job status and progress"""
-    job = job_store.get_job(job_id)
+@app.get("/status/{job_id}", response_class=Response)
+async def get_status(job_id: str, request: Request):
+    """
+    Get job status and progress.
+    Supports If-None-Match: an unchanged job answers 304 with no body.
+    """
+    job = await store_call(job_store.get_job, job_id)
     
     if not job:
         raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
     
-    return StatusResponse(
-        job_id=job_id,
-        status=job["status"],
-        progress=job.get("progress"),
-        result=job.get("result"),
-        error=job.get("error"),
-        created_at=job["created_at"],
-        updated_at=job["updated_at"]
+    # Status changes while the job runs: caches may keep it but must
+    # revalidate every time, which the ETag makes cheap
+    etag = f'W/"{job["updated_at"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return msgspec_response(
+        StatusResponse(
+            job_id=job_id,
+            status=JobStatus(job["status"]).value,
+            progress=job.get("progress"),
+            result=job.get("result"),
+            error=job.get("error"),
+            created_at=job["created_at"],
+            updated_at=job["updated_at"]
+        ),
+        headers=headers
+    )
+
+
+@app.get("/status/{job_id}/stream")
+async def stream_status(job_id: str):
+    """
+    Push job status as Server-Sent Events until the job finishes.
+    Replaces polling /status/{job_id}: one event per change.
+    """
+    if not await store_call(job_store.get_job, job_id):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    
+    async def events():
+        event = job_events.setdefault(job_id, asyncio.Event())
+        job_listeners[job_id] = job_listeners.get(job_id, 0) + 1
+        last_update = None
+        try:
+            while True:
+                job = await store_call(job_store.get_job, job_id)
+                if job is None:
+                    return
+                
+                if job["updated_at"] != last_update:
+                    last_update = job["updated_at"]
+                    yield f"data: {orjson.dumps({'job_id': job_id, **job}).decode()}\n\n"
+                
+                if job["status"] in (JobStatus.COMPLETED, JobStatus.FAILED):
+                    return
+                
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=STREAM_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Runs on disconnect too, so no awaiting here
+            job_listeners[job_id] -= 1
+            if not job_listeners[job_id]:
+                del job_listeners[job_id]
+                job_events.pop(job_id, None)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
 @app.get("/jobs")
 async def list_jobs():
     """List all jobs (for debugging)"""
-    return {"jobs": job_store.list_jobs()}
+    return {"jobs": await store_call(job_store.list_jobs)}
@@ -0,0 +1,61 @@
+"""
+Celery worker entry point.
+
+When CELERY_BROKER_URL is set, /webhook enqueues jobs here instead of
+running them inside the web process, so jobs survive web restarts and
+workers scale independently:
+
+    celery -A app.tasks worker -c $(nproc) -Q cosine
+
+Job status still lives in the shared (Redis) job store, so /status works
+the same regardless of where a job runs.
+"""
+
+import os
+from functools import partial
+
+from celery import Celery
+from celery.signals import worker_init
+
+from .calculator import CosineCalculatorService
+from .job_store import job_store, JobStatus, RedisJobStore, ThrottledProgress, report_progress
+
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+
+celery_app = Celery("cosine", broker=CELERY_BROKER_URL)
+celery_app.conf.update(
+    task_default_queue="cosine",
+    task_ignore_result=True,         # status/result go to job_store
+    task_acks_late=True,             # re-deliver if a worker dies mid-job
+    worker_prefetch_multiplier=1,    # jobs are long; don't hoard them
+)
+
+
+@worker_init.connect
+def check_job_store(**kwargs):
+    # An in-memory store here would be invisible to the web process,
+    # leaving every job "queued" forever
+    if not isinstance(job_store, RedisJobStore):
+        raise RuntimeError("Celery workers require REDIS_URL so the web process can see job status.")
+
+
+@celery_app.task(name="cosine.process_spreadsheet")
+def process_spreadsheet_task(job_id: str, request: dict, request_key: str) -> None:
+    job_store.update_status(job_id, JobStatus.PROCESSING, progress={"stage": "initializing"})
+
+    try:
+        result = CosineCalculatorService.process_spreadsheet(
+            request["spreadsheet_id"],
+            request["sheet_name"],
+            request["article_column"],
+            request["target_column"],
+            request["output_column"],
+            request["threshold_column"],
+            ThrottledProgress(partial(report_progress, job_id))
+        )
+        job_store.update_status(job_id, JobStatus.COMPLETED, result=result)
+    except Exception as e:
+        job_store.update_status(job_id, JobStatus.FAILED, error=str(e))
+        raise
+    finally:
+        job_store.release_request(request_key, job_id)